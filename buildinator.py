@@ -1,17 +1,55 @@
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, render_template, request, jsonify, send_file, make_response
 from flask_sqlalchemy import SQLAlchemy
-from threading import Thread
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor, Future
 import docker
+import os
+import sys
+import ast
+import hashlib
+import textwrap
+import tempfile
+import shutil
+import glob
+import atexit
+from functools import lru_cache
 import logging
-from queue import Queue
+import sqlite3
+import time
+import json
+import re
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from queue import Queue, Empty
 import stripe
 from PIL import Image, ImageDraw, ImageFont
 from io import BytesIO
+from llama_cpp import Llama
+from sqlalchemy import event, update, inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects.sqlite import insert
+from stdlib_modules import STDLIB_MODULE_NAMES
 
 app = Flask(__name__)
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///app_builder.db"
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {"pool_size": 5, "max_overflow": 10, "pool_pre_ping": True}
 db = SQLAlchemy(app)
 
+# Use WAL so status/queue reads don't block the build worker's writes
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA busy_timeout=5000")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA cache_size=-65536")
+        cursor.execute("PRAGMA mmap_size=268435456")
+        cursor.execute("PRAGMA wal_autocheckpoint=1000")
+        cursor.close()
+
 # Load config
 class Config:
     LOGGING_ENABLED = True
@@ -19,8 +57,22 @@ class Config:
     LLM_API = "local"
     LLM_API_KEY = "your_llm_api_key"
     DOCKER_HOST = "localhost"
-    DOCKER_IMAGE_PYTHON = "python:latest"
-    DOCKER_IMAGE_DOTNET = "mcr.microsoft.com/dotnet/core/sdk:latest"
+    DOCKER_IMAGE_PYTHON = os.environ.get('DOCKER_IMAGE_PYTHON', "python:latest")
+    DOCKER_IMAGE_DOTNET = os.environ.get('DOCKER_IMAGE_DOTNET', "mcr.microsoft.com/dotnet/core/sdk:latest")
+    DOCKER_PIP_CACHE_VOLUME = "buildinator-pip-cache"
+    DOCKER_NUGET_CACHE_VOLUME = "buildinator-nuget-cache"
+    PIP_INDEX_URL = os.environ.get('PIP_INDEX_URL')
+    LLM_MODEL_PATH = os.environ.get('LLM_MODEL_PATH', './model/Mistral-Nemo-Instruct-2407-Q4_K_M.gguf')
+    # llama.cpp picks its AVX2/AVX-512 CPU kernels automatically; -1 GPU layers offloads everything to CUDA/Metal
+    LLAMA_N_THREADS = int(os.environ.get('LLAMA_N_THREADS', os.cpu_count() or 8))
+    LLAMA_N_GPU_LAYERS = int(os.environ.get('LLAMA_N_GPU_LAYERS', -1))
+    LLAMA_N_BATCH = int(os.environ.get('LLAMA_N_BATCH', 512))
+    # Concurrent completions sent to a remote LLM API, which batches them server-side
+    LLM_PARALLEL_REQUESTS = int(os.environ.get('LLM_PARALLEL_REQUESTS', 8))
+    # Ask a llama.cpp server to reuse the KV cache for the shared prompt prefix; other servers may reject the field
+    LLM_API_CACHE_PROMPT = os.environ.get('LLM_API_CACHE_PROMPT', 'False') == 'True'
+    # Send OpenAI's prompt_cache_key routing hint; also not understood by every server
+    LLM_API_PROMPT_CACHE_KEY = os.environ.get('LLM_API_PROMPT_CACHE_KEY', 'False') == 'True'
     ENABLED = True
 
 config = Config()
@@ -42,14 +94,18 @@ class Iteration(db.Model):
     input_code = db.Column(db.Text, nullable=False)
     output_code = db.Column(db.Text, nullable=False)
     build_output = db.Column(db.Text, nullable=False)
-    is_release_candidate = db.Column(db.Boolean, default=False)
+    # A build with only whitespace output is a release candidate; SQLite computes this on insert
+    is_release_candidate = db.Column(db.Boolean, db.Computed("length(trim(build_output, char(32, 9, 10, 11, 12, 13))) = 0", persisted=True))
+    input_hash = db.Column(db.String(64), index=True)
+
+    __table_args__ = (db.Index("ix_iter_rc", "is_release_candidate"),)
 
     def __repr__(self):
         return f"Iteration('{self.app_name}', '{self.prompt}', '{self.id}')"
 
 class App(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(100), nullable=False)
+    name = db.Column(db.String(100), nullable=False, unique=True)
     prompt = db.Column(db.Text, nullable=False)
     input_code = db.Column(db.Text, nullable=False)
     language = db.Column(db.String(10), nullable=False)
@@ -58,110 +114,373 @@ class App(db.Model):
     def __repr__(self):
         return f"App('{self.name}', '{self.prompt}', '{self.id}')"
 
+# Partial index over queued apps only, for the /queue lookup. SQLite only uses a
+# partial index when the query's WHERE implies its own, so this must be "= 1", not "IS 1"
+db.Index("ix_app_is_queued", App.is_queued, sqlite_where=App.is_queued == db.true())
+
+# LLM parameters
+llama_params = {
+    "n_threads": config.LLAMA_N_THREADS,
+    "n_threads_batch": config.LLAMA_N_THREADS,
+    "use_mmap": True,
+    # Set tensor_split (e.g. [0.5, 0.5]) to spread offloaded layers across GPUs
+    "n_gpu_layers": config.LLAMA_N_GPU_LAYERS,
+    "main_gpu": 0,
+    "tensor_split": None,
+    "flash_attn": True,
+    # Quantize the KV cache to Q8_0 (GGML type 8)
+    "type_k": 8,
+    "type_v": 8,
+    "n_ctx": 131072,
+    "rope_freq_base": 0,
+    "numa": False,
+    "verbose": True,
+    "n_batch": config.LLAMA_N_BATCH,
+    "n_ubatch": config.LLAMA_N_BATCH
+}
+
+# Sampling parameters, passed per completion rather than to the model constructor
+MAX_COMPLETION_TOKENS = 8192
+completion_params = {
+    "top_p": 0.95,
+    "top_k": 40,
+    "temperature": 0.8,
+    "repeat_penalty": 1.01,
+    "max_tokens": MAX_COMPLETION_TOKENS,
+    "typical_p": 0.68,
+    "min_p": 0,
+    "frequency_penalty": 0,
+    "presence_penalty": 0.5,
+    # The prompt opens the code block, so generation ends at its closing fence
+    "stop": ["```"]
+}
+
+# Load the model once and reuse it across iterations
+_LLAMA = None
+_LLAMA_LOCK = Lock()
+
+def get_llama():
+    global _LLAMA
+    with _LLAMA_LOCK:
+        if _LLAMA is None:
+            _LLAMA = Llama(config.LLM_MODEL_PATH, **llama_params)
+    return _LLAMA
+
+# Static instructions come first so the resident model reuses their evaluated tokens across iterations
+PROMPT_PREAMBLE = "Generate ONLY a complete revision of the {language} code, addressing any build errors, surrounded by triple backticks:\n"
+
+def build_prompt(prompt, input_code, language):
+    # End with the opening fence so the completion is the code itself
+    return PROMPT_PREAMBLE.format(language=language) + f"```{input_code}```\n{prompt}\n```{language}\n"
+
+# Keep connections to the remote LLM API alive between iterations
+_HTTP = requests.Session()
+_HTTP_ADAPTER = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=Retry(total=2, backoff_factor=0.2))
+_HTTP.mount("https://", _HTTP_ADAPTER)
+_HTTP.mount("http://", _HTTP_ADAPTER)
+
+def read_streamed_completion(response):
+    # Accumulate server-sent completion chunks, stopping at the closing fence in case the server ignores stop
+    text = ""
+    search_from = 0
+    # SSE is always UTF-8, but requests falls back to ISO-8859-1 for a text/event-stream without a charset
+    response.encoding = "utf-8"
+    for line in response.iter_lines(decode_unicode=True):
+        if not line or not line.startswith("data:"):
+            continue
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            break
+        text += json.loads(data)['choices'][0].get('text') or ""
+        if text.find("```", search_from) >= 0:
+            break
+        # A fence may be split across chunks
+        search_from = max(0, len(text) - 2)
+    return text
+
+# A language tag the model repeats on the first line of the block the prompt opened
+_LANGUAGE_TAG = re.compile(r"\A[ \t]*(?:py|python3?|cs|csharp|c#)[ \t]*\n", re.IGNORECASE)
+
+def extract_code(text):
+    # The prompt already opened the block, so the text is the code up to the closing fence
+    return _LANGUAGE_TAG.sub("", text.split("```", 1)[0], count=1)
+
+def build_completion_request(prompt, input_code, language):
+    body = {
+        "prompt": build_prompt(prompt, input_code, language),
+        "max_tokens": MAX_COMPLETION_TOKENS,
+        "temperature": 0.8,
+        "top_p": 0.95,
+        "n": 1,
+        "stream": True,
+        "logprobs": None,
+        "echo": False,
+        "stop": ["```"]
+    }
+    if config.LLM_API_CACHE_PROMPT:
+        body["cache_prompt"] = True
+    if config.LLM_API_PROMPT_CACHE_KEY:
+        # Route requests with the same per-language preamble to the same prefix cache
+        body["prompt_cache_key"] = f"buildinator-{language}"
+    return body
+
 # LLM function
 def run_llm(prompt, input_code, language):
     try:
         if config.LLM_API == 'local':
-            # Instantiate LLM for each iteration
-            llama_params = {
-                "n_threads": 0,
-                "n_threads_batch": 0,
-                "use_mmap": False,
-                "use_mlock": False,
-                "n_gpu_layers": 0,
-                "main_gpu": 0,
-                "tensor_split": "",
-                "top_p": 0.95,
-                "n_ctx": 131072,
-                "rope_freq_base": 0,
-                "numa": False,
-                "verbose": True,
-                "top_k": 40,
-                "temperature": 0.8,
-                "repeat_penalty": 1.01,
-                "max_tokens": 65536,
-                "typical_p": 0.68,
-                "n_batch": 2048,
-                "min_p": 0,
-                "frequency_penalty": 0,
-                "presence_penalty": 0.5
-            }
-            llama = Llama("./model/Mistral-Nemo-Instruct-2407-Q8_0.gguf", **llama_params)
+            llama = get_llama()
 
             # Generate complete revision of code, addressing build errors, surrounded by triple backticks
-            response = llama.create_completion( f"Generate ONLY a complete revision of the {language} code, addressing any build errors, surrounded by triple backticks:\\n```{input_code}```\\n{prompt}")
-            output_code = response['choices'][0]['text'].split("```")[1].split("```")[0]
+            response = llama.create_completion(build_prompt(prompt, input_code, language), **completion_params)
+            text = response['choices'][0]['text']
         else:
             # Use OpenAI-compatible API
-            import requests
-            response = requests.post(
+            response = _HTTP.post(
                 f"{config.LLM_API}/completions",
                 headers={"Authorization": f"Bearer {config.LLM_API_KEY}"},
-                json={
-                    "prompt": f"Generate ONLY a complete revision of the {language} code, addressing any build errors, surrounded by triple backticks:\\n```{input_code}```\\n{prompt}",
-                    "max_tokens": 65536,
-                    "temperature": 0.8,
-                    "top_p": 0.95,
-                    "n": 1,
-                    "stream": False,
-                    "logprobs": None,
-                    "echo": False,
-                    "stop": None,
-                    "timeout": None
-                }
+                json=build_completion_request(prompt, input_code, language),
+                stream=True,
+                timeout=(5, 300)
             )
-            output_code = response.json()['choices'][0]['text'].split("```")[1].split("```")[0]
+            with response:
+                response.raise_for_status()
+                text = read_streamed_completion(response)
+        if not text.strip():
+            # A model that opens its own block stops at that fence before writing any code
+            logging.warning("LLM completion was empty, most likely stopped at an opening code fence")
+            return input_code
+        output_code = extract_code(text)
+        # An empty or truncated completion would build as an empty, passing program
+        if not output_code.strip():
+            raise ValueError("LLM returned no code")
         return output_code
     except Exception as e:
         # Handle LLM call failure, return input code without throwing errors
         logging.error(f"LLM call failed: {e}")
         return input_code
 
-# Docker execution function
-def execute_code(code, language):
-    client = docker.DockerClient(base_url=f"{config.DOCKER_HOST}:2375")
+# Warm Docker containers, reused across builds to avoid per-build cold starts
+CONTAINER_POOL_SIZE = 2
+CONTAINER_MAX_USES = 20
+container_pools = {"py": Queue(), "cs": Queue()}
+container_uses = {}
+container_workdirs = {}
+live_containers = {}
+
+# Marks pool containers so ones left behind by an earlier process can be found and removed
+CONTAINER_LABEL = "buildinator.pool"
+WORKDIR_PREFIX = "buildinator-"
+
+# Build files are written here and bind-mounted read-only, in RAM where available
+WORKDIR_ROOT = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+# One Docker client shared by every build, so its connection pool stays warm
+_DOCKER_CLIENT = None
+_DOCKER_CLIENT_LOCK = Lock()
+
+def get_docker_client():
+    global _DOCKER_CLIENT
+    with _DOCKER_CLIENT_LOCK:
+        if _DOCKER_CLIENT is None:
+            _DOCKER_CLIENT = docker.DockerClient(base_url=f"{config.DOCKER_HOST}:2375")
+    return _DOCKER_CLIENT
+
+def create_container(client, language):
+    image = config.DOCKER_IMAGE_PYTHON if language == "py" else config.DOCKER_IMAGE_DOTNET
+    try:
+        client.images.get(image)
+    except docker.errors.ImageNotFound:
+        client.images.pull(image)
     if language == "py":
-        # Create requirements.txt
-        requirements = []
-        for line in code.splitlines():
-            if "import" in line:
-                module = line.split("import")[1].strip()
-                requirements.append(module)
-        with open("requirements.txt", "w") as f:
-            for requirement in requirements:
-                f.write(f"{requirement}\\n")
-
-        # Run Docker container
-        container = client.containers.run(
-            config.DOCKER_IMAGE_PYTHON,
-            command=f"bash -c 'pip install -r requirements.txt && python main.py'",
+        environment = {"PIP_DISABLE_PIP_VERSION_CHECK": "1", "PIP_ROOT_USER_ACTION": "ignore"}
+        if config.PIP_INDEX_URL:
+            environment["PIP_INDEX_URL"] = config.PIP_INDEX_URL
+        workdir = tempfile.mkdtemp(prefix=WORKDIR_PREFIX, dir=WORKDIR_ROOT)
+        container = client.containers.create(
+            image,
+            command="sleep infinity",
             detach=True,
-            remove=True,
-            stdout=True,
-            stderr=True,
+            labels=[CONTAINER_LABEL],
+            environment=environment,
+            working_dir="/work",
+            tmpfs={"/tmp": ""},
+            mem_limit="512m",
+            pids_limit=128,
             volumes={
-                "/app": {
-                    "bind": "/app",
+                workdir: {
+                    "bind": "/work",
+                    "mode": "ro"
+                },
+                # Keep downloaded wheels across containers
+                config.DOCKER_PIP_CACHE_VOLUME: {
+                    "bind": "/root/.cache/pip",
                     "mode": "rw"
                 }
             }
         )
-        build_output = container.logs(stdout=True, stderr=True).decode("utf-8")
-        return build_output
-    elif language == "cs":
-        container = client.containers.run(
-            config.DOCKER_IMAGE_DOTNET,
-            command=f"bash -c 'dotnet run'",
+        container_workdirs[container.id] = workdir
+    else:
+        container = client.containers.create(
+            image,
+            command="sleep infinity",
             detach=True,
-            remove=True,
-            stdout=True,
-            stderr=True
+            labels=[CONTAINER_LABEL],
+            volumes={
+                # Keep restored NuGet packages across containers
+                config.DOCKER_NUGET_CACHE_VOLUME: {
+                    "bind": "/root/.nuget/packages",
+                    "mode": "rw"
+                }
+            }
         )
-        build_output = container.logs(stdout=True, stderr=True).decode("utf-8")
-        return build_output
+    container.start()
+    container_uses[container.id] = 0
+    live_containers[container.id] = container
+    return container
+
+def reap_stale_containers(client):
+    # Remove pool containers and workdirs orphaned by a previous run that didn't shut down cleanly
+    for container in client.containers.list(all=True, filters={"label": CONTAINER_LABEL}):
+        if container.id not in live_containers:
+            try:
+                container.remove(force=True)
+            except Exception as e:
+                logging.error(f"Failed to remove stale container {container.id}: {e}")
+    known_workdirs = set(container_workdirs.values())
+    for workdir in glob.glob(os.path.join(WORKDIR_ROOT or tempfile.gettempdir(), WORKDIR_PREFIX + "*")):
+        if workdir not in known_workdirs:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+def warm_container_pools():
+    try:
+        client = get_docker_client()
+        reap_stale_containers(client)
+        for language, pool in container_pools.items():
+            while pool.qsize() < CONTAINER_POOL_SIZE:
+                pool.put(create_container(client, language))
+    except Exception as e:
+        logging.error(f"Failed to warm container pools: {e}")
+
+def acquire_container(client, language):
+    try:
+        return container_pools[language].get_nowait()
+    except Empty:
+        return create_container(client, language)
+
+def release_container(container, language):
+    container_uses[container.id] += 1
+    pool = container_pools[language]
+    # Recycle containers periodically so state left behind by builds doesn't accumulate
+    if container_uses[container.id] >= CONTAINER_MAX_USES or pool.qsize() >= CONTAINER_POOL_SIZE:
+        discard_container(container)
+    else:
+        pool.put(container)
+
+def discard_container(container):
+    container_uses.pop(container.id, None)
+    live_containers.pop(container.id, None)
+    workdir = container_workdirs.pop(container.id, None)
+    if workdir:
+        _requirements_digests.pop(workdir, None)
+        shutil.rmtree(workdir, ignore_errors=True)
+    try:
+        container.remove(force=True)
+    except Exception as e:
+        logging.error(f"Failed to remove container {container.id}: {e}")
 
-# Build queue
-build_queue = Queue()
+@atexit.register
+def shutdown_container_pools():
+    for container in list(live_containers.values()):
+        discard_container(container)
+
+def reset_container(container):
+    # Containers are shared between apps, so kill anything a build left running (including
+    # processes that escaped the timeout with setsid) and clear /tmp before the next build
+    container.exec_run(["bash", "-c", "kill -9 -1; rm -rf /tmp/* /tmp/.[!.]*"])
+
+# Modules that ship with Python and must not be pip installed. sys.builtin_module_names only
+# lists modules compiled into the interpreter, so older Pythons use a static list instead
+STDLIB_MODULES = frozenset(getattr(sys, "stdlib_module_names", STDLIB_MODULE_NAMES))
+
+# Digest of the code each workdir's requirements.txt was last written for
+_requirements_digests = {}
+
+def find_requirements(code):
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError):
+        # Let the build itself report the syntax error
+        return []
+    modules = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules.update(alias.name.split(".")[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+            modules.add(node.module.split(".")[0])
+    return sorted(modules - STDLIB_MODULES)
+
+def write_requirements(workdir, code):
+    digest = hashlib.blake2b(code.encode()).digest()
+    if digest == _requirements_digests.get(workdir):
+        return
+    with open(os.path.join(workdir, "requirements.txt"), "w") as f:
+        f.write("".join(f"{requirement}\n" for requirement in find_requirements(code)))
+    _requirements_digests[workdir] = digest
+
+# Limits for a single build run
+BUILD_TIMEOUT = 60
+MAX_BUILD_OUTPUT = 1024 * 1024
+
+# Runs the build script ($1) under a timeout ($0) and reports a failure that printed nothing,
+# so a silent hang or non-zero exit never leaves an empty build output
+BUILD_RUNNER = (
+    'timeout "$0" bash -c "$1"; s=$?; '
+    'if [ $s -eq 124 ]; then echo "Build timed out after $0 seconds"; '
+    'elif [ $s -ne 0 ]; then echo "Build exited with status $s"; fi'
+)
+
+# Docker execution function
+def execute_code(code, language):
+    # The scripts are fixed; generated code only ever reaches the container as a file
+    if language == "py":
+        # pip's progress output would keep every build with a third-party import from being a release candidate
+        script = "pip install -qq --prefer-binary --no-compile -r requirements.txt > /tmp/pip.log 2>&1 || { cat /tmp/pip.log; exit 1; }; python main.py"
+    elif language == "cs":
+        script = "dotnet run"
+    else:
+        return f"Unsupported language: {language}"
+
+    # Run in a warm container, streaming output and keeping only the most recent part of it
+    client = get_docker_client()
+    container = acquire_container(client, language)
+    output = bytearray()
+    try:
+        if language == "py":
+            workdir = container_workdirs[container.id]
+            with open(os.path.join(workdir, "main.py"), "w") as f:
+                f.write(code)
+            # Create requirements.txt
+            write_requirements(workdir, code)
+        result = container.exec_run(["bash", "-c", BUILD_RUNNER, str(BUILD_TIMEOUT), script], stdout=True, stderr=True, stream=True)
+        for chunk in result.output:
+            output += chunk
+            if len(output) > MAX_BUILD_OUTPUT:
+                del output[:-MAX_BUILD_OUTPUT]
+        reset_container(container)
+    except Exception:
+        discard_container(container)
+        raise
+    release_container(container, language)
+    build_output = output.decode("utf-8", errors="replace")
+    return build_output
+
+# Build pipeline: local LLM generation is serialized behind the shared model, while
+# Docker execution runs in parallel so one app builds while the next generates
+_LLM_POOL = ThreadPoolExecutor(max_workers=1 if config.LLM_API == 'local' else config.LLM_PARALLEL_REQUESTS)
+_EXEC_POOL = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
+
+# Serialize database writes so concurrent commits don't contend for SQLite's write lock
+_WRITE_LOCK = Lock()
 
 # Web interface routes
 @app.route("/")
@@ -175,56 +494,93 @@ def build():
     language = request.form["language"]
     input_code = request.form["input_code"]
 
-    # Check if app already exists
-    app = App.query.filter_by(name=app_name).first()
-    if app:
-        app.prompt = prompt
-        app.input_code = input_code
-        app.language = language
-        app.is_queued = True
-    else:
-        app = App(name=app_name, prompt=prompt, input_code=input_code, language=language, is_queued=True)
-        db.session.add(app)
+    with _WRITE_LOCK:
+        # Create the app, or update it if one with this name already exists
+        values = dict(prompt=prompt, input_code=input_code, language=language, is_queued=True)
+        stmt = (
+            insert(App)
+            .values(name=app_name, **values)
+            .on_conflict_do_update(index_elements=["name"], set_=values)
+            .returning(App.id)
+        )
+        app_id = db.session.execute(stmt).scalar_one()
+        db.session.commit()
 
-    db.session.commit()
+    # Reuse a previous release candidate built from identical inputs
+    build = make_build(app_id, app_name, prompt, input_code, language)
+    cached = find_cached_iteration(build["input_hash"])
+    if cached:
+        reuse_iteration(build, cached.app_name, cached.output_code, cached.build_output)
+        return jsonify({"message": "App built from cache"})
 
     # Add app to build queue
-    build_queue.put(app.id)
+    queue_build(build)
 
     return jsonify({"message": "App added to build queue"})
 
 @app.route("/queue")
 def queue():
-    apps = App.query.filter_by(is_queued=True).all()
-    return render_template("queue.html", apps=apps)
+    # Only the columns the template shows, as plain rows instead of ORM objects
+    apps = db.session.execute(
+        db.select(App.id, App.name, App.prompt, App.input_code, App.language)
+        .filter_by(is_queued=True)
+        .order_by(App.id)
+    ).all()
+    response = make_response(render_template("queue.html", apps=apps))
+    response.add_etag()
+    return response.make_conditional(request)
 
 @app.route("/delete_app/<int:app_id>")
 def delete_app(app_id):
-    app = App.query.get(app_id)
-    if app:
-        db.session.delete(app)
-        db.session.commit()
+    with _WRITE_LOCK:
+        app = db.session.get(App, app_id)
+        if app:
+            db.session.delete(app)
+            db.session.commit()
     return jsonify({"message": "App deleted"})
 
 @app.route("/delete_iteration/<int:iteration_id>")
 def delete_iteration(iteration_id):
-    iteration = Iteration.query.get(iteration_id)
-    if iteration:
-        db.session.delete(iteration)
-        db.session.commit()
+    with _WRITE_LOCK:
+        iteration = db.session.get(Iteration, iteration_id)
+        if iteration:
+            db.session.delete(iteration)
+            db.session.commit()
     return jsonify({"message": "Iteration deleted"})
 
 @app.route("/remove_from_queue/<int:app_id>")
 def remove_from_queue(app_id):
-    app = App.query.get(app_id)
-    if app:
-        app.is_queued = False
-        db.session.commit()
+    with _WRITE_LOCK:
+        app = db.session.get(App, app_id)
+        if app:
+            app.is_queued = False
+            db.session.commit()
     return jsonify({"message": "App removed from queue"})
 
+# Code snapshot rendering
+SNAPSHOT_FONT = ImageFont.load_default()
+SNAPSHOT_SIZE = (800, 600)
+SNAPSHOT_LINE_WIDTH = 120
+SNAPSHOT_LINE_HEIGHT = 12
+
+@lru_cache(maxsize=128)
+def render_code_png(code):
+    img = Image.new('RGB', SNAPSHOT_SIZE, color = (73, 109, 137))
+    d = ImageDraw.Draw(img)
+    # Wrap once and draw line by line, stopping at the bottom of the image
+    lines = []
+    for line in code.splitlines():
+        lines.extend(textwrap.wrap(line, width=SNAPSHOT_LINE_WIDTH, drop_whitespace=False) or [""])
+    max_lines = (SNAPSHOT_SIZE[1] - 10) // SNAPSHOT_LINE_HEIGHT
+    for i, line in enumerate(lines[:max_lines]):
+        d.text((10, 10 + i * SNAPSHOT_LINE_HEIGHT), line, fill=(255,255,0), font=SNAPSHOT_FONT)
+    buf = BytesIO()
+    img.save(buf, format='PNG', optimize=False, compress_level=1)
+    return buf.getvalue()
+
 @app.route("/download_iteration/<int:iteration_id>")
 def download_iteration(iteration_id):
-    iteration = Iteration.query.get(iteration_id)
+    iteration = db.session.get(Iteration, iteration_id)
     if iteration:
         if config.ENABLED:
             # Create Stripe payment intent
@@ -235,63 +591,224 @@ def download_iteration(iteration_id):
             )
             return render_template("payment.html", payment_intent=payment_intent, iteration_id=iteration_id)
         else:
+            # Skip rendering when the client already has the snapshot of this code
+            etag = hashlib.blake2b(iteration.output_code.encode(), digest_size=16).hexdigest()
+            if request.if_none_match.contains(etag):
+                response = make_response("", 304)
+                response.set_etag(etag)
+                return response
+
             # Generate PNG snapshot of code
-            font = ImageFont.load_default()
-            img = Image.new('RGB', (800, 600), color = (73, 109, 137))
-            d = ImageDraw.Draw(img)
-            d.text((10,10), iteration.output_code, fill=(255,255,0), font=font)
-            img.save('code.png')
-            return send_file('code.png', as_attachment=True)
+            png = render_code_png(iteration.output_code)
+            return send_file(BytesIO(png), mimetype='image/png', as_attachment=True, download_name=f'iteration_{iteration_id}.png', etag=etag)
     return jsonify({"message": "Iteration not found"})
 
+# The dashboard polls the status, so serve it from a short-lived cache
+STATUS_TTL = 1
+_status_cache = {"expires": 0, "body": ""}
+
 @app.route("/get_status")
 def get_status():
-    apps = App.query.all()
-    status = ""
-    for app in apps:
-        status += f"{app.name}: {app.is_queued}<br>"
-    return status
+    now = time.monotonic()
+    if now >= _status_cache["expires"]:
+        rows = db.session.execute(db.select(App.name, App.is_queued)).all()
+        _status_cache["body"] = "".join(f"{name}: {is_queued}<br>" for name, is_queued in rows)
+        _status_cache["expires"] = now + STATUS_TTL
+    response = make_response(_status_cache["body"])
+    response.headers["Cache-Control"] = f"max-age={STATUS_TTL}"
+    return response
+
+# Builds currently in the pipeline, keyed by input hash
+_INFLIGHT = {}
+_INFLIGHT_LOCK = Lock()
 
 # Build worker
-def build_worker():
+def queue_build(build):
+    # Identical inputs already in the pipeline share its result instead of building again
+    with _INFLIGHT_LOCK:
+        inflight = _INFLIGHT.get(build["input_hash"])
+        if inflight is None:
+            _INFLIGHT[build["input_hash"]] = Future()
+    if inflight is not None:
+        inflight.add_done_callback(lambda future: store_coalesced_build(build, future))
+        return
+    _LLM_POOL.submit(generate_code, build).add_done_callback(lambda future: start_execution(build, future))
+
+def finish_inflight(input_hash, result=None, error=None):
+    with _INFLIGHT_LOCK:
+        inflight = _INFLIGHT.pop(input_hash, None)
+    if inflight is not None:
+        if error is not None:
+            inflight.set_exception(error)
+        else:
+            inflight.set_result(result)
+
+def store_coalesced_build(build, future):
+    if future.exception() is not None:
+        logging.error(f"Build failed for {build['app_name']}: {future.exception()}")
+        store_failed_build(build, future.exception())
+        return
+    reuse_iteration(build, *future.result())
+
+def store_failed_build(build, error):
+    # Record the error as the build output so the app leaves the queue and the failure is visible
+    build.setdefault("output_code", build["input_code"])
+    store_iteration(build, f"Build failed: {error}")
+
+def reuse_iteration(build, source_app_name, output_code, build_output):
+    # An app that already has this iteration just leaves the queue; other apps get their own copy
+    if source_app_name == build["app_name"]:
+        store_iteration(build, None)
+    else:
+        build["output_code"] = output_code
+        store_iteration(build, build_output)
+
+def get_input_hash(prompt, input_code, language):
+    return hashlib.blake2b(f"{language}\0{prompt}\0{input_code}".encode(), digest_size=32).hexdigest()
+
+def find_cached_iteration(input_hash):
+    # Only successful builds are reused; resubmitting inputs that failed samples the LLM again
+    return Iteration.query.filter_by(input_hash=input_hash, is_release_candidate=True).first()
+
+def make_build(app_id, app_name, prompt, input_code, language):
+    return {
+        "app_id": app_id,
+        "app_name": app_name,
+        "prompt": prompt,
+        "input_code": input_code,
+        "language": language,
+        "input_hash": get_input_hash(prompt, input_code, language)
+    }
+
+def generate_code(build):
+    # Leaving the app context removes the thread's session, so nothing is held open during generation
+    with app.app_context():
+        # Skip the LLM and Docker entirely when these inputs were built since they were queued
+        cached = find_cached_iteration(build["input_hash"])
+        if cached:
+            build["cached_from"] = cached.app_name
+            build["output_code"] = cached.output_code
+            build["build_output"] = cached.build_output
+            return build
+
+    # Run LLM
+    build["output_code"] = run_llm(build["prompt"], build["input_code"], build["language"])
+    return build
+
+def start_execution(build, future):
+    try:
+        future.result()
+    except Exception as e:
+        logging.error(f"Code generation failed: {e}")
+        store_failed_build(build, e)
+        finish_inflight(build["input_hash"], error=e)
+        return
+    _EXEC_POOL.submit(execute_build, build)
+
+def execute_build(build):
+    try:
+        if "cached_from" in build:
+            build_output = build["build_output"]
+            reuse_iteration(build, build["cached_from"], build["output_code"], build_output)
+        else:
+            # Execute code in Docker
+            build_output = execute_code(build["output_code"], build["language"])
+            store_iteration(build, build_output)
+
+        # Log build result
+        logging.info(f"Build result for {build['app_name']}: {build_output}")
+        finish_inflight(build["input_hash"], result=(build["app_name"], build["output_code"], build_output))
+    except Exception as e:
+        logging.error(f"Build failed for {build['app_name']}: {e}")
+        store_failed_build(build, e)
+        finish_inflight(build["input_hash"], error=e)
+
+# Finished builds waiting to be written by the store worker
+store_queue = Queue()
+
+def store_iteration(build, build_output):
+    # A build_output of None only takes the app off the queue without adding an iteration
+    store_queue.put((build, build_output))
+
+def write_builds(builds):
+    with _WRITE_LOCK:
+        try:
+            for build, build_output in builds:
+                if build_output is not None:
+                    db.session.add(Iteration(
+                        app_name=build["app_name"],
+                        prompt=build["prompt"],
+                        input_code=build["input_code"],
+                        output_code=build["output_code"],
+                        build_output=build_output,
+                        input_hash=build["input_hash"]
+                    ))
+                db.session.execute(update(App).where(App.id == build["app_id"]).values(is_queued=False))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+def store_worker():
     while True:
-        app_id = build_queue.get()
-        if app_id:
-            app = App.query.get(app_id)
-            if app:
-                # Run LLM
-                output_code = run_llm(app.prompt, app.input_code, app.language)
-
-                # Execute code in Docker
-                build_output = execute_code(output_code, app.language)
-
-                # Store iteration in database
-                iteration = Iteration(
-                    app_name=app.name,
-                    prompt=app.prompt,
-                    input_code=app.input_code,
-                    output_code=output_code,
-                    build_output=build_output,
-                    is_release_candidate=(build_output.strip() == "")
-                )
-                db.session.add(iteration)
-                db.session.commit()
-
-                # Update app status
-                app.is_queued = False
-                db.session.commit()
-
-                # Log build result
-                logging.info(f"Build result for {app.name}: {build_output}")
-
-        build_queue.task_done()
-
-# Start build worker
-build_thread = Thread(target=build_worker)
-build_thread.daemon = True
-build_thread.start()
+        # Write every build that finished in the meantime in a single transaction
+        pending = [store_queue.get()]
+        while True:
+            try:
+                pending.append(store_queue.get_nowait())
+            except Empty:
+                break
+        with app.app_context():
+            try:
+                write_builds(pending)
+                continue
+            except Exception as e:
+                logging.error(f"Failed to store {len(pending)} iteration(s) together, retrying one by one: {e}")
+
+            # Retry each build on its own so one bad row doesn't lose the rest
+            for build, build_output in pending:
+                try:
+                    write_builds([(build, build_output)])
+                except Exception as e:
+                    logging.error(f"Failed to store iteration for {build['app_name']}: {e}")
+                    try:
+                        # Still take the app off the queue
+                        write_builds([(build, None)])
+                    except Exception as e:
+                        logging.error(f"Failed to dequeue {build['app_name']}: {e}")
+
+# Start store worker
+store_thread = Thread(target=store_worker)
+store_thread.daemon = True
+store_thread.start()
+
+def check_schema():
+    # create_all() never alters existing tables, so a database from an older version has to be recreated
+    problems = []
+    if sqlite3.sqlite_version_info < (3, 35):
+        problems.append(f"SQLite {sqlite3.sqlite_version} is too old; 3.35 or newer is required")
+    inspector = inspect(db.engine)
+    unique_columns = [c["column_names"] for c in inspector.get_unique_constraints(App.__tablename__)]
+    unique_columns += [i["column_names"] for i in inspector.get_indexes(App.__tablename__) if i["unique"]]
+    if ["name"] not in unique_columns:
+        problems.append(f"{App.__tablename__}.name has no UNIQUE constraint")
+    iteration_columns = {c["name"]: c for c in inspector.get_columns(Iteration.__tablename__)}
+    if "input_hash" not in iteration_columns:
+        problems.append(f"{Iteration.__tablename__}.input_hash is missing")
+    if "computed" not in iteration_columns.get("is_release_candidate", {}):
+        problems.append(f"{Iteration.__tablename__}.is_release_candidate is not a generated column")
+    if problems:
+        raise SystemExit(
+            "The database schema is out of date: " + "; ".join(problems) + ". "
+            "See 'Database' in README.md for how to recreate or migrate app_builder.db."
+        )
 
 if __name__ == "__main__":
     with app.app_context():
         db.create_all()
-    app.run(debug=True)
+        check_schema()
+    debug = True
+    # The reloader's parent process never serves requests, so only the child warms containers
+    if not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        warm_container_pools()
+    app.run(debug=debug)
@@ -7,6 +7,16 @@ class Config:
     STRIPE_PUBLISHABLE_KEY = os.environ.get('STRIPE_PUBLISHABLE_KEY', '')
     ENABLED = os.environ.get('ENABLED', 'False') == 'True'
     MAX_IDENTICAL_ITERATIONS = 3
-    DOCKER_IMAGE_PYTHON = "python:3.9-slim"
-    DOCKER_IMAGE_DOTNET = "mcr.microsoft.com/dotnet/sdk:6.0"
+    DOCKER_IMAGE_PYTHON = os.environ.get('DOCKER_IMAGE_PYTHON', "python:3.9-slim")
+    DOCKER_IMAGE_DOTNET = os.environ.get('DOCKER_IMAGE_DOTNET', "mcr.microsoft.com/dotnet/sdk:6.0")
+    DOCKER_PIP_CACHE_VOLUME = "buildinator-pip-cache"
+    DOCKER_NUGET_CACHE_VOLUME = "buildinator-nuget-cache"
+    PIP_INDEX_URL = os.environ.get('PIP_INDEX_URL')
     LOGGING_ENABLED = True
+    LLM_MODEL_PATH = os.environ.get('LLM_MODEL_PATH', './model/Mistral-Nemo-Instruct-2407-Q4_K_M.gguf')
+    LLAMA_N_THREADS = int(os.environ.get('LLAMA_N_THREADS', os.cpu_count() or 8))
+    LLAMA_N_GPU_LAYERS = int(os.environ.get('LLAMA_N_GPU_LAYERS', -1))
+    LLAMA_N_BATCH = int(os.environ.get('LLAMA_N_BATCH', 512))
+    LLM_PARALLEL_REQUESTS = int(os.environ.get('LLM_PARALLEL_REQUESTS', 8))
+    LLM_API_CACHE_PROMPT = os.environ.get('LLM_API_CACHE_PROMPT', 'False') == 'True'
+    LLM_API_PROMPT_CACHE_KEY = os.environ.get('LLM_API_PROMPT_CACHE_KEY', 'False') == 'True'